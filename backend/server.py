@@ -1,27 +1,51 @@
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, List
-from datetime import datetime
+from typing import Optional, List, Literal
+from datetime import datetime, timedelta
 from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+from cachetools import LRUCache, TTLCache
+from arq import create_pool
+from arq.connections import RedisSettings
 import os
 import subprocess
 import asyncio
-import requests
-import json
+import httpx
+import logging
+import orjson
 import re
+import signal
+import socket
+from collections import deque
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Compression
+class BuildGZipMiddleware(GZipMiddleware):
+    """GZip that leaves the SSE log stream alone so events aren't held in the compressor"""
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/api/build/logs/stream":
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+app.add_middleware(BuildGZipMiddleware, minimum_size=1024)
+
+# CORS; comma-separated list of allowed frontend origins
+FRONTEND_ORIGINS = os.getenv("FRONTEND_ORIGINS", "http://localhost:3000,http://localhost:8081")
 
-# CORS
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=[origin.strip() for origin in FRONTEND_ORIGINS.split(",") if origin.strip()],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -29,17 +53,92 @@ app.add_middleware(
 
 # MongoDB
 MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
-client = AsyncIOMotorClient(MONGO_URL)
+# A small warm pool avoids paying connect + auth on the first requests
+client = AsyncIOMotorClient(
+    MONGO_URL,
+    maxPoolSize=50,
+    minPoolSize=5,
+    serverSelectionTimeoutMS=2000
+)
 db = client.aosp_builder
 
 # Collections
 builds_collection = db.builds
 sources_collection = db.sources
 
+# Singleton {"_id": "active"} document naming the running build, shared by all
+# workers; build_status below is only a write-through cache in the worker
+# that is running the build
+state_collection = db.build_state
+ACTIVE_STATE_ID = "active"
+
+# The process running a build refreshes heartbeat_at on the slot; a claim
+# whose heartbeat is older than the timeout belongs to a dead process
+ACTIVE_HEARTBEAT_INTERVAL = 30
+ACTIVE_CLAIM_TIMEOUT = 120
+
+# Shared HTTP client for GitHub/GitLab API calls
+http_client = httpx.AsyncClient(timeout=15)
+
+# Normalized search results keyed by (provider, source_type, query)
+_search_cache = TTLCache(maxsize=2048, ttl=300)
+
+# GitHub ETags with their payloads, kept past the TTL for conditional requests
+_github_etags = LRUCache(maxsize=2048)
+
+# Optional token; raises the GitHub search rate limit for this server
+GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
+
+@app.on_event("startup")
+async def init_database():
+    # Force the connection pool to open before the first request arrives
+    await client.admin.command("ping")
+    await builds_collection.create_index([("started_at", -1)])
+
+# Builds run in a separate arq worker (see worker.py) when REDIS_URL is set;
+# otherwise they run in-process as background tasks
+REDIS_URL = os.getenv("REDIS_URL")
+BUILD_LOG_CHANNEL = "aosp_builder:build_logs"
+
+# Redis connection: the job queue in the API, the log relay in the worker
+redis_state = {"pool": None}
+
+@app.on_event("startup")
+async def connect_job_queue():
+    if REDIS_URL:
+        redis_state["pool"] = await create_pool(RedisSettings.from_dsn(REDIS_URL))
+
+@app.on_event("startup")
+async def reconcile_build_slot():
+    # In-process builds die with their process, so a slot left behind by an
+    # earlier run of this server (crash, --reload) can be freed right away
+    if not REDIS_URL:
+        await reconcile_active_build()
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.aclose()
+
+@app.on_event("shutdown")
+async def close_job_queue():
+    if redis_state["pool"] is not None:
+        await redis_state["pool"].aclose()
+
+def encode_mongo_value(value):
+    """orjson fallback for the BSON types it doesn't know; datetimes are native"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class MongoJSONResponse(ORJSONResponse):
+    """Encodes raw Mongo documents in one orjson pass"""
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=encode_mongo_value)
+
 # Models
 class SearchRequest(BaseModel):
     query: str
-    source_type: str  # device, kernel, vendor
+    source_type: Literal["device", "kernel", "vendor"]
 
 class SourceConfig(BaseModel):
     source_type: str  # device, kernel, vendor
@@ -61,88 +160,141 @@ class DependencyCheckResponse(BaseModel):
     missing: List[str]
     system_ready: bool
 
+# Build tools can emit very long lines (full compiler invocations)
+LOG_LINE_LIMIT = 1024 * 1024
+
+# Build progress markers such as "[42%]", matched on raw output bytes
+MKA_PROGRESS_RE = re.compile(rb'\[(\d+)%\]')
+
+# Only the tail of the build output is kept in memory
+MAX_LOG_LINES = 2000
+STATUS_LOG_LINES = 100
+
+# Log lines are persisted to Mongo in batches; the stored array keeps only
+# the most recent lines so the build document stays under the 16MB limit
+LOG_FLUSH_LINES = 200
+LOG_FLUSH_INTERVAL = 2.0
+MAX_PERSISTED_LOG_LINES = 20000
+
 # Global build status
 build_status = {
     "active": False,
     "stage": "",
     "progress": 0,
     "eta": "",
-    "logs": [],
+    "logs": deque(maxlen=MAX_LOG_LINES),
     "build_id": None
 }
 
+# Log lines not yet written to the build document; the lock keeps batches
+# from concurrent flushes in order
+log_buffer = {"lines": []}
+log_flush_lock = asyncio.Lock()
+
+# One queue per connected /api/build/logs/stream client; None ends the stream
+MAX_SUBSCRIBER_BACKLOG = 1000
+SSE_LINE_BREAK_RE = re.compile(r"\r\n|\r|\n")
+log_subscribers = set()
+
 @app.get("/api/health")
 async def health():
     return {"status": "healthy", "service": "AOSP ROM Builder"}
 
+# Cached dependency check result, invalidated when any of these paths change
+_system_check_cache = {"key": None, "value": None}
+SYSTEM_CHECK_PATHS = ["/var/lib/dpkg/status", "/usr/bin", os.path.expanduser("~/bin")]
+
+def system_check_key() -> tuple:
+    """Modification times of the paths that package installs touch"""
+    key = []
+    for path in SYSTEM_CHECK_PATHS:
+        try:
+            key.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            key.append(None)
+    return tuple(key)
+
+async def is_package_installed(package: str) -> bool:
+    """Check whether a single required package is available"""
+    try:
+        if package == "build-essential":
+            process = await asyncio.create_subprocess_exec(
+                "dpkg", "-l", "build-essential",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            stdout, _ = await process.communicate()
+            return "ii  build-essential" in stdout.decode(errors="replace")
+        
+        process = await asyncio.create_subprocess_exec(
+            "which", package,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        return await process.wait() == 0
+    except Exception:
+        return False
+
 @app.get("/api/system/check")
 async def check_system():
     """Check for required dependencies and system requirements"""
+    key = system_check_key()
+    if _system_check_cache["value"] is not None and _system_check_cache["key"] == key:
+        return _system_check_cache["value"]
+    
     required_packages = [
         "git", "curl", "repo", "python3", "build-essential",
         "bc", "bison", "flex", "libssl-dev", "zip"
     ]
     
-    installed = []
-    missing = []
+    checks = await asyncio.gather(*[is_package_installed(p) for p in required_packages])
     
-    for package in required_packages:
-        try:
-            if package == "repo":
-                result = subprocess.run(["which", "repo"], capture_output=True, text=True)
-                if result.returncode == 0:
-                    installed.append(package)
-                else:
-                    missing.append(package)
-            elif package == "build-essential":
-                result = subprocess.run(["dpkg", "-l", "build-essential"], capture_output=True, text=True)
-                if "ii  build-essential" in result.stdout:
-                    installed.append(package)
-                else:
-                    missing.append(package)
-            else:
-                result = subprocess.run(["which", package], capture_output=True, text=True)
-                if result.returncode == 0:
-                    installed.append(package)
-                else:
-                    missing.append(package)
-        except Exception as e:
-            missing.append(package)
+    installed = [p for p, ok in zip(required_packages, checks) if ok]
+    missing = [p for p, ok in zip(required_packages, checks) if not ok]
     
-    return {
+    result = {
         "installed": installed,
         "missing": missing,
         "system_ready": len(missing) == 0
     }
+    _system_check_cache["key"] = key
+    _system_check_cache["value"] = result
+    return result
 
 @app.post("/api/system/install-dependencies")
 async def install_dependencies(background_tasks: BackgroundTasks):
     """Install missing dependencies"""
-    try:
-        # Update apt
-        subprocess.run(["sudo", "apt-get", "update"], check=True)
-        
-        # Install packages
-        packages = [
-            "git", "curl", "python3", "build-essential",
-            "bc", "bison", "flex", "libssl-dev", "zip",
-            "unzip", "git-core", "gnupg", "flex", "bison",
-            "gperf", "build-essential", "zip", "curl",
-            "zlib1g-dev", "gcc-multilib", "g++-multilib",
-            "libc6-dev-i386", "lib32ncurses5-dev",
-            "x11proto-core-dev", "libx11-dev", "lib32z-dev",
-            "libgl1-mesa-dev", "libxml2-utils", "xsltproc"
-        ]
-        
-        subprocess.run(["sudo", "apt-get", "install", "-y"] + packages, check=True)
-        
-        # Install repo tool
+    packages = sorted({
+        "git", "curl", "python3", "build-essential",
+        "bc", "bison", "flex", "libssl-dev", "zip",
+        "unzip", "git-core", "gnupg", "gperf",
+        "zlib1g-dev", "gcc-multilib", "g++-multilib",
+        "libc6-dev-i386", "lib32ncurses5-dev",
+        "x11proto-core-dev", "libx11-dev", "lib32z-dev",
+        "libgl1-mesa-dev", "libxml2-utils", "xsltproc"
+    })
+    repo_path = os.path.expanduser("~/bin/repo")
+    
+    async def install_packages():
+        await run_command("sudo", "apt-get", "update")
+        await run_command("sudo", "apt-get", "install", "-y", "--no-install-recommends", *packages)
+    
+    async def install_repo_tool():
         os.makedirs(os.path.expanduser("~/bin"), exist_ok=True)
-        subprocess.run([
+        await run_command(
             "curl", "https://storage.googleapis.com/git-repo-downloads/repo",
-            "-o", os.path.expanduser("~/bin/repo")
-        ], check=True)
-        subprocess.run(["chmod", "a+x", os.path.expanduser("~/bin/repo")], check=True)
+            "-o", repo_path
+        )
+        await run_command("chmod", "a+x", repo_path)
+    
+    try:
+        # apt and the repo download are independent, so run them side by side.
+        # Both chains always run to completion; cancelling one would kill
+        # apt-get mid-transaction and leave the dpkg lock to a retry
+        results = await asyncio.gather(install_packages(), install_repo_tool(), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
         
         return {"status": "success", "message": "Dependencies installed successfully"}
     except Exception as e:
@@ -151,6 +303,10 @@ async def install_dependencies(background_tasks: BackgroundTasks):
 @app.post("/api/search/github")
 async def search_github(request: SearchRequest):
     """Search GitHub for device trees, kernels, or vendor repos"""
+    cache_key = ("github", request.source_type, request.query.lower().strip())
+    if cache_key in _search_cache:
+        return _search_cache[cache_key]
+    
     try:
         # Build search query
         search_terms = {
@@ -159,13 +315,26 @@ async def search_github(request: SearchRequest):
             "vendor": f"{request.query} vendor blobs android"
         }
         
-        query = search_terms.get(request.source_type, request.query)
+        query = search_terms[request.source_type]
         
-        # GitHub API search
-        url = f"https://api.github.com/search/repositories?q={query}&sort=stars&order=desc&per_page=10"
-        response = requests.get(url)
+        # GitHub API search; httpx takes care of encoding the query
+        url = "https://api.github.com/search/repositories"
+        params = {"q": query, "sort": "stars", "order": "desc", "per_page": 10}
+        headers = {"Accept": "application/vnd.github+json"}
+        if GITHUB_TOKEN:
+            headers["Authorization"] = f"Bearer {GITHUB_TOKEN}"
         
-        if response.status_code == 200:
+        cached = _github_etags.get(cache_key)
+        if cached:
+            headers["If-None-Match"] = cached[0]
+        
+        response = await http_client.get(url, params=params, headers=headers)
+        
+        if response.status_code == 304 and cached:
+            # Unchanged since last time; 304s don't count against the rate limit
+            _search_cache[cache_key] = cached[1]
+            return cached[1]
+        elif response.status_code == 200:
             data = response.json()
             results = []
             
@@ -179,7 +348,11 @@ async def search_github(request: SearchRequest):
                     "updated_at": repo["updated_at"]
                 })
             
-            return {"status": "success", "results": results}
+            payload = {"status": "success", "results": results}
+            _search_cache[cache_key] = payload
+            if "ETag" in response.headers:
+                _github_etags[cache_key] = (response.headers["ETag"], payload)
+            return payload
         else:
             raise HTTPException(status_code=response.status_code, detail="GitHub API error")
     except Exception as e:
@@ -188,6 +361,10 @@ async def search_github(request: SearchRequest):
 @app.post("/api/search/gitlab")
 async def search_gitlab(request: SearchRequest):
     """Search GitLab for device trees, kernels, or vendor repos"""
+    cache_key = ("gitlab", request.source_type, request.query.lower().strip())
+    if cache_key in _search_cache:
+        return _search_cache[cache_key]
+    
     try:
         search_terms = {
             "device": f"{request.query} device tree android",
@@ -195,11 +372,12 @@ async def search_gitlab(request: SearchRequest):
             "vendor": f"{request.query} vendor blobs android"
         }
         
-        query = search_terms.get(request.source_type, request.query)
+        query = search_terms[request.source_type]
         
         # GitLab API search
-        url = f"https://gitlab.com/api/v4/projects?search={query}&order_by=star_count&per_page=10"
-        response = requests.get(url)
+        url = "https://gitlab.com/api/v4/projects"
+        params = {"search": query, "order_by": "star_count", "per_page": 10}
+        response = await http_client.get(url, params=params)
         
         if response.status_code == 200:
             data = response.json()
@@ -215,7 +393,9 @@ async def search_gitlab(request: SearchRequest):
                     "updated_at": repo["last_activity_at"]
                 })
             
-            return {"status": "success", "results": results}
+            payload = {"status": "success", "results": results}
+            _search_cache[cache_key] = payload
+            return payload
         else:
             raise HTTPException(status_code=response.status_code, detail="GitLab API error")
     except Exception as e:
@@ -226,11 +406,42 @@ async def start_build(config: BuildConfig, background_tasks: BackgroundTasks):
     """Start AOSP build process"""
     global build_status
     
-    if build_status["active"]:
+    build_id = str(ObjectId())
+    
+    # Claim the active slot atomically; the upsert collides if another
+    # worker already holds it
+    now = datetime.utcnow()
+    try:
+        previous = await state_collection.find_one_and_update(
+            {
+                "_id": ACTIVE_STATE_ID,
+                "$or": [
+                    {"build_id": None},
+                    {"heartbeat_at": {"$exists": False}},
+                    {"heartbeat_at": {"$lt": now - timedelta(seconds=ACTIVE_CLAIM_TIMEOUT)}}
+                ]
+            },
+            {
+                "$set": {
+                    "build_id": build_id,
+                    "last_build_id": build_id,
+                    "owner": build_owner(),
+                    "claimed_at": now,
+                    "heartbeat_at": now
+                }
+            },
+            upsert=True
+        )
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="A build is already in progress")
     
+    if previous and previous.get("build_id"):
+        # Took over a stale claim; its build will never report back
+        await mark_build_interrupted(previous["build_id"])
+    
     # Create build record
     build_record = {
+        "_id": ObjectId(build_id),
         "device_name": config.device_name,
         "device_codename": config.device_codename,
         "android_version": config.android_version,
@@ -242,17 +453,27 @@ async def start_build(config: BuildConfig, background_tasks: BackgroundTasks):
         "logs": []
     }
     
-    result = await builds_collection.insert_one(build_record)
-    build_id = str(result.inserted_id)
-    
-    build_status["active"] = True
-    build_status["build_id"] = build_id
-    build_status["stage"] = "Initializing"
-    build_status["progress"] = 0
-    build_status["logs"] = []
+    try:
+        await builds_collection.insert_one(build_record)
+    except Exception as e:
+        await release_active_build(build_id)
+        raise HTTPException(status_code=500, detail=f"Failed to create build record: {str(e)}")
     
-    # Start build in background
-    background_tasks.add_task(execute_build, config, build_id)
+    if redis_state["pool"] is not None:
+        # Hand the build to the worker so the API process stays responsive
+        try:
+            await redis_state["pool"].enqueue_job("build_task", config.model_dump(), build_id)
+        except Exception as e:
+            await release_active_build(build_id)
+            await update_build_status(build_id, f"Build failed: {str(e)}", 0, "failed")
+            raise HTTPException(status_code=500, detail=f"Failed to queue build: {str(e)}")
+    else:
+        # Mark the build active now so clients that connect before the
+        # background task starts (e.g. the log stream) see it
+        reset_build_status(build_id)
+        
+        # Start build in background
+        background_tasks.add_task(execute_build, config, build_id)
     
     return {"status": "success", "build_id": build_id, "message": "Build started"}
 
@@ -260,6 +481,11 @@ async def execute_build(config: BuildConfig, build_id: str):
     """Execute the actual build process"""
     global build_status
     
+    reset_build_status(build_id)
+    await touch_active_build(build_id)
+    heartbeat = asyncio.create_task(keep_build_claimed(build_id))
+    flusher = asyncio.create_task(flush_logs_periodically(build_id))
+    
     try:
         build_dir = os.path.expanduser(config.build_directory)
         os.makedirs(build_dir, exist_ok=True)
@@ -291,10 +517,107 @@ async def execute_build(config: BuildConfig, build_id: str):
         # Complete
         await update_build_status(build_id, "Build completed", 100, "completed")
         
+    except asyncio.CancelledError:
+        # Job timeout or worker shutdown; the command helpers have already
+        # killed their children by the time this runs
+        try:
+            await update_build_status(build_id, "Build failed: build was cancelled", build_status["progress"], "failed")
+        except Exception:
+            logger.warning("Failed to record cancelled build", exc_info=True)
+        raise
     except Exception as e:
         await update_build_status(build_id, f"Build failed: {str(e)}", build_status["progress"], "failed")
     finally:
-        build_status["active"] = False
+        heartbeat.cancel()
+        flusher.cancel()
+        await flush_build_logs(build_id)
+        
+        # Tear down in-memory state before freeing the slot, so a build
+        # started once it is free can't have its state reset by this one
+        if build_status["build_id"] == build_id:
+            build_status["active"] = False
+            close_log_subscribers()
+        await relay_log_lines(None)
+        
+        try:
+            await release_active_build(build_id)
+        except Exception:
+            # The heartbeat stops with this build, so the claim goes stale
+            logger.warning("Failed to release the active build slot", exc_info=True)
+
+def reset_build_status(build_id: str):
+    """Point the in-memory build state at a new build"""
+    build_status["active"] = True
+    build_status["build_id"] = build_id
+    build_status["stage"] = "Initializing"
+    build_status["progress"] = 0
+    build_status["logs"] = deque(maxlen=MAX_LOG_LINES)
+    log_buffer["lines"] = []
+
+def build_owner() -> str:
+    """Identifies the process holding the active build slot"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+async def release_active_build(build_id: str):
+    """Free the active build slot if it is still held by build_id"""
+    await state_collection.update_one(
+        {"_id": ACTIVE_STATE_ID, "build_id": build_id},
+        {"$set": {"build_id": None}}
+    )
+
+def is_claim_fresh(state: dict) -> bool:
+    """Whether the holder of the slot has checked in recently"""
+    heartbeat_at = state.get("heartbeat_at")
+    return heartbeat_at is not None and datetime.utcnow() - heartbeat_at < timedelta(seconds=ACTIVE_CLAIM_TIMEOUT)
+
+async def touch_active_build(build_id: str):
+    """Record this process as the one running build_id and refresh its heartbeat"""
+    await state_collection.update_one(
+        {"_id": ACTIVE_STATE_ID, "build_id": build_id},
+        {"$set": {"owner": build_owner(), "heartbeat_at": datetime.utcnow()}}
+    )
+
+async def keep_build_claimed(build_id: str):
+    """Refresh the slot heartbeat for as long as the build runs"""
+    while True:
+        await asyncio.sleep(ACTIVE_HEARTBEAT_INTERVAL)
+        try:
+            await touch_active_build(build_id)
+        except Exception:
+            logger.warning("Failed to refresh build heartbeat", exc_info=True)
+
+async def mark_build_interrupted(build_id: str):
+    """Fail a build whose process went away without finishing it"""
+    await builds_collection.update_one(
+        {"_id": ObjectId(build_id), "status": {"$nin": ["completed", "failed"]}},
+        {
+            "$set": {
+                "status": "failed",
+                "current_stage": "Build failed: build process exited unexpectedly",
+                "updated_at": datetime.utcnow()
+            }
+        }
+    )
+
+async def reconcile_active_build():
+    """Free the slot if the process on this host that claimed it no longer exists"""
+    state = await state_collection.find_one({"_id": ACTIVE_STATE_ID}) or {}
+    build_id = state.get("build_id")
+    host, _, pid = (state.get("owner") or "").rpartition(":")
+    if not build_id or host != socket.gethostname() or not pid.isdigit():
+        return
+    
+    if int(pid) != os.getpid():
+        try:
+            os.kill(int(pid), 0)
+            return  # Still running
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            return  # Exists, owned by another user
+    
+    await mark_build_interrupted(build_id)
+    await release_active_build(build_id)
 
 async def update_build_status(build_id: str, stage: str, progress: int, status: str = "building"):
     """Update build status in database and global state"""
@@ -305,19 +628,173 @@ async def update_build_status(build_id: str, stage: str, progress: int, status:
     
     log_entry = f"[{datetime.utcnow().strftime('%H:%M:%S')}] {stage}"
     build_status["logs"].append(log_entry)
+    publish_log_line(log_entry)
     
-    await builds_collection.update_one(
-        {"_id": ObjectId(build_id)},
-        {
-            "$set": {
-                "status": status,
-                "progress": progress,
-                "current_stage": stage,
-                "updated_at": datetime.utcnow()
-            },
-            "$push": {"logs": log_entry}
-        }
+    # Persist the stage line together with any buffered output
+    async with log_flush_lock:
+        pending = log_buffer["lines"] + [log_entry]
+        log_buffer["lines"] = []
+        
+        try:
+            await builds_collection.update_one(
+                {"_id": ObjectId(build_id)},
+                {
+                    "$set": {
+                        "status": status,
+                        "progress": progress,
+                        "current_stage": stage,
+                        "updated_at": datetime.utcnow()
+                    },
+                    "$push": {"logs": {"$each": pending, "$slice": -MAX_PERSISTED_LOG_LINES}}
+                }
+            )
+        except Exception:
+            requeue_build_logs(pending)
+            raise
+    
+    await relay_log_lines(pending)
+
+async def append_build_log(line: str):
+    """Record a line of build output, flushing to the database in batches"""
+    build_status["logs"].append(line)
+    log_buffer["lines"].append(line)
+    publish_log_line(line)
+    
+    # Quiet periods are covered by flush_logs_periodically
+    if len(log_buffer["lines"]) >= LOG_FLUSH_LINES:
+        await flush_build_logs(build_status["build_id"])
+
+def publish_log_line(line: str):
+    """Hand a log line to every streaming client"""
+    for queue in list(log_subscribers):
+        try:
+            queue.put_nowait(line)
+        except asyncio.QueueFull:
+            # Slow client; drop the line rather than stall the build
+            pass
+
+async def relay_log_lines(lines: Optional[List[str]]):
+    """Forward a batch of log lines to API processes over Redis; None ends their streams"""
+    if redis_state["pool"] is not None:
+        try:
+            await redis_state["pool"].publish(BUILD_LOG_CHANNEL, orjson.dumps(lines))
+        except Exception:
+            # Live streaming is best effort; the lines are already in Mongo
+            logger.warning("Failed to relay build log lines", exc_info=True)
+
+def close_log_subscribers():
+    """Tell every streaming client that the build has finished"""
+    for queue in list(log_subscribers):
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+def requeue_build_logs(lines: List[str]):
+    """Put lines from a failed write back at the front of the buffer"""
+    log_buffer["lines"] = (lines + log_buffer["lines"])[-MAX_PERSISTED_LOG_LINES:]
+
+async def flush_build_logs(build_id: str):
+    """Write buffered log lines to the build document.
+    
+    A failed write is logged and its lines are kept for the next flush; a
+    database hiccup must not abort the command whose output is being read.
+    """
+    async with log_flush_lock:
+        pending = log_buffer["lines"]
+        log_buffer["lines"] = []
+        
+        if not pending:
+            return
+        
+        try:
+            await builds_collection.update_one(
+                {"_id": ObjectId(build_id)},
+                {
+                    "$set": {"progress": build_status["progress"]},
+                    "$push": {"logs": {"$each": pending, "$slice": -MAX_PERSISTED_LOG_LINES}}
+                }
+            )
+        except Exception:
+            logger.warning("Failed to persist %d build log lines; will retry", len(pending), exc_info=True)
+            requeue_build_logs(pending)
+            return
+    
+    await relay_log_lines(pending)
+
+async def flush_logs_periodically(build_id: str):
+    """Flush buffered lines while a command is quiet, e.g. during long link steps"""
+    while True:
+        await asyncio.sleep(LOG_FLUSH_INTERVAL)
+        await flush_build_logs(build_id)
+
+async def stop_process(process: asyncio.subprocess.Process):
+    """Kill a child's whole process group if it is still running, then reap it"""
+    if process.returncode is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+async def run_command(*args: str, cwd: Optional[str] = None):
+    """Run a command without blocking the event loop, raising on failure"""
+    # Each child gets its own process group so stop_process can take down
+    # everything it spawned if we are interrupted
+    process = await asyncio.create_subprocess_exec(*args, cwd=cwd, start_new_session=True)
+    try:
+        if await process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, list(args))
+    finally:
+        await stop_process(process)
+
+async def stream_command(*args: str, cwd: str, on_line):
+    """Run a command, awaiting on_line for every raw line of combined output"""
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        cwd=cwd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        limit=LOG_LINE_LIMIT,
+        start_new_session=True
     )
+    try:
+        async for raw_line in read_output_lines(process.stdout):
+            await on_line(raw_line)
+        if await process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, list(args))
+    finally:
+        await stop_process(process)
+
+async def read_output_lines(stream: asyncio.StreamReader):
+    """Yield raw output lines, truncating any longer than LOG_LINE_LIMIT"""
+    oversized = None
+    while True:
+        try:
+            line = await stream.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            # Final line without a trailing newline
+            line = e.partial
+            if oversized is not None:
+                yield oversized + b" [line truncated]"
+            elif line:
+                yield line
+            return
+        except asyncio.LimitOverrunError as e:
+            # Keep the head of the line and discard the rest up to its newline
+            chunk = await stream.read(e.consumed)
+            if oversized is None:
+                oversized = chunk[:LOG_LINE_LIMIT]
+            continue
+        
+        if oversized is not None:
+            yield oversized + b" [line truncated]\n"
+            oversized = None
+        else:
+            yield line
+
+async def log_output_line(raw_line: bytes):
+    """Record a raw line of command output in the build log"""
+    await append_build_log(raw_line.decode(errors="replace").strip())
 
 async def setup_sources(config: BuildConfig, build_dir: str):
     """Clone or copy source repositories"""
@@ -329,13 +806,14 @@ async def setup_sources(config: BuildConfig, build_dir: str):
     
     for source, name in sources:
         if source.method in ["github", "gitlab", "url"]:
-            # Clone from URL
+            # Shallow clone from URL; the build only needs the current tip
             target_dir = os.path.join(build_dir, f"{name}_temp")
-            subprocess.run(["git", "clone", source.value, target_dir], check=True)
+            await run_command("git", "clone", "--depth=1", "--single-branch", source.value, target_dir)
         elif source.method == "local":
-            # Copy from local path
+            # Copy from local path; reflinks make this copy-on-write where the
+            # filesystem supports it without ever sharing blocks with the user's tree
             target_dir = os.path.join(build_dir, f"{name}_temp")
-            subprocess.run(["cp", "-r", source.value, target_dir], check=True)
+            await run_command("cp", "-r", "--reflink=auto", source.value, target_dir)
 
 async def init_aosp_repo(config: BuildConfig, build_dir: str):
     """Initialize AOSP repository"""
@@ -349,41 +827,40 @@ async def init_aosp_repo(config: BuildConfig, build_dir: str):
     branch = branch_map.get(config.android_version, "android-15.0.0_r1")
     
     # Initialize repo
-    subprocess.run([
+    await run_command(
         os.path.expanduser("~/bin/repo"), "init",
         "-u", "https://android.googlesource.com/platform/manifest",
-        "-b", branch
-    ], cwd=build_dir, check=True)
+        "-b", branch,
+        cwd=build_dir
+    )
 
 async def sync_aosp_source(build_dir: str):
     """Sync AOSP source code"""
     # This will take a long time
-    process = subprocess.Popen(
-        [os.path.expanduser("~/bin/repo"), "sync", "-c", "-j4"],
+    jobs = min(16, os.cpu_count() or 4)
+    await stream_command(
+        os.path.expanduser("~/bin/repo"), "sync", "-c",
+        "--no-clone-bundle", "--optimized-fetch", f"-j{jobs}",
         cwd=build_dir,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True
+        on_line=log_output_line
     )
-    
-    for line in process.stdout:
-        build_status["logs"].append(line.strip())
-    
-    process.wait()
 
 async def copy_device_files(config: BuildConfig, build_dir: str):
-    """Copy device-specific files to proper AOSP directories"""
-    # Copy device tree
+    """Move device-specific files into the proper AOSP directories"""
+    # The temp checkouts are not used after this stage, so they are moved
+    # into place (a rename within build_dir) rather than copied
+    
+    # Move device tree
     device_dest = os.path.join(build_dir, "device", config.device_codename)
-    subprocess.run(["cp", "-r", os.path.join(build_dir, "device_temp"), device_dest], check=True)
+    await run_command("mv", os.path.join(build_dir, "device_temp"), device_dest)
     
-    # Copy kernel
+    # Move kernel
     kernel_dest = os.path.join(build_dir, "kernel", config.device_codename)
-    subprocess.run(["cp", "-r", os.path.join(build_dir, "kernel_temp"), kernel_dest], check=True)
+    await run_command("mv", os.path.join(build_dir, "kernel_temp"), kernel_dest)
     
-    # Copy vendor
+    # Move vendor
     vendor_dest = os.path.join(build_dir, "vendor", config.device_codename)
-    subprocess.run(["cp", "-r", os.path.join(build_dir, "vendor_temp"), vendor_dest], check=True)
+    await run_command("mv", os.path.join(build_dir, "vendor_temp"), vendor_dest)
 
 async def run_lunch(config: BuildConfig, build_dir: str):
     """Run lunch command to set build environment"""
@@ -392,89 +869,134 @@ async def run_lunch(config: BuildConfig, build_dir: str):
     # Source build environment and run lunch
     cmd = f"source build/envsetup.sh && lunch {lunch_target}"
     
-    process = subprocess.Popen(
-        cmd,
-        shell=True,
-        cwd=build_dir,
-        executable="/bin/bash",
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True
-    )
-    
-    for line in process.stdout:
-        build_status["logs"].append(line.strip())
-    
-    process.wait()
+    await stream_command("/bin/bash", "-c", cmd, cwd=build_dir, on_line=log_output_line)
 
 async def run_mka(config: BuildConfig, build_dir: str):
     """Run mka command to build ROM"""
     # Source environment and run mka
     cmd = f"source build/envsetup.sh && lunch {config.device_codename}-{config.build_variant} && mka bacon"
     
-    process = subprocess.Popen(
-        cmd,
-        shell=True,
-        cwd=build_dir,
-        executable="/bin/bash",
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True
-    )
-    
-    progress = 50
-    for line in process.stdout:
-        build_status["logs"].append(line.strip())
+    async def on_line(raw_line: bytes):
+        await log_output_line(raw_line)
         
         # Parse progress from build output
-        if "[" in line and "%]" in line:
-            match = re.search(r'\[(\d+)%\]', line)
+        if b"%]" in raw_line:
+            match = MKA_PROGRESS_RE.search(raw_line)
             if match:
                 percentage = int(match.group(1))
                 progress = 50 + (percentage * 0.5)  # Scale to 50-100%
                 build_status["progress"] = int(progress)
     
-    process.wait()
+    await stream_command("/bin/bash", "-c", cmd, cwd=build_dir, on_line=on_line)
+
+async def load_build_status(log_lines: int) -> dict:
+    """Current build status, from memory in the building worker, else from Mongo"""
+    state = await state_collection.find_one({"_id": ACTIVE_STATE_ID}) or {}
+    active_id = state.get("build_id")
+    build_id = active_id or state.get("last_build_id")
+    if active_id and not is_claim_fresh(state):
+        active_id = None
+    
+    if build_id and build_id == build_status["build_id"]:
+        return {**build_status, "logs": list(build_status["logs"])[-log_lines:]}
+    
+    build = None
+    if build_id:
+        build = await builds_collection.find_one(
+            {"_id": ObjectId(build_id)},
+            {"current_stage": 1, "progress": 1, "status": 1, "logs": {"$slice": -log_lines}}
+        )
+    if not build:
+        return {**build_status, "logs": list(build_status["logs"])[-log_lines:]}
+    
+    return {
+        "active": active_id is not None,
+        "stage": build.get("current_stage", ""),
+        "progress": build.get("progress", 0),
+        "eta": "",
+        "logs": build.get("logs", []),
+        "build_id": build_id
+    }
 
 @app.get("/api/build/status")
 async def get_build_status():
     """Get current build status"""
-    return build_status
+    return await load_build_status(STATUS_LOG_LINES)
 
-@app.get("/api/build/logs")
+@app.get("/api/build/logs", deprecated=True)
 async def get_build_logs():
-    """Get build logs"""
-    return {"logs": build_status["logs"][-100:]}  # Return last 100 lines
+    """Get build logs (deprecated, use /api/build/logs/stream)"""
+    status = await load_build_status(STATUS_LOG_LINES)  # Return last 100 lines
+    return {"logs": status["logs"]}
+
+def format_sse_event(line: str) -> str:
+    """One SSE event for a log line; embedded CR/LF become separate data fields"""
+    parts = SSE_LINE_BREAK_RE.split(line)
+    return "".join(f"data: {part}\n" for part in parts) + "\n"
+
+@app.get("/api/build/logs/stream")
+async def stream_build_logs():
+    """Stream build log lines as Server-Sent Events"""
+    if redis_state["pool"] is not None:
+        return StreamingResponse(relay_event_stream(), media_type="text/event-stream")
+    
+    queue = asyncio.Queue(maxsize=MAX_SUBSCRIBER_BACKLOG)
+    
+    async def event_stream():
+        log_subscribers.add(queue)
+        try:
+            if not build_status["active"]:
+                return
+            while True:
+                line = await queue.get()
+                if line is None:
+                    break
+                yield format_sse_event(line)
+        finally:
+            log_subscribers.discard(queue)
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+async def relay_event_stream():
+    """Log events published by the build worker"""
+    pubsub = redis_state["pool"].pubsub()
+    await pubsub.subscribe(BUILD_LOG_CHANNEL)
+    try:
+        state = await state_collection.find_one({"_id": ACTIVE_STATE_ID}) or {}
+        if not state.get("build_id"):
+            return
+        async for message in pubsub.listen():
+            if message["type"] != "message":
+                continue
+            lines = orjson.loads(message["data"])
+            if lines is None:
+                break
+            for line in lines:
+                yield format_sse_event(line)
+    finally:
+        await pubsub.unsubscribe(BUILD_LOG_CHANNEL)
+        await pubsub.aclose()
 
 @app.get("/api/builds/history")
 async def get_build_history():
     """Get all build history"""
-    builds = await builds_collection.find().sort("started_at", -1).limit(20).to_list(20)
+    # Logs can be large; history only needs the summary fields
+    builds = await builds_collection.find({}, {"logs": 0}).sort("started_at", -1).limit(20).to_list(20)
     
-    for build in builds:
-        build["_id"] = str(build["_id"])
-        if "started_at" in build:
-            build["started_at"] = build["started_at"].isoformat()
-        if "updated_at" in build:
-            build["updated_at"] = build["updated_at"].isoformat()
-    
-    return {"builds": builds}
+    return MongoJSONResponse({"builds": builds})
 
 @app.get("/api/builds/{build_id}")
 async def get_build(build_id: str):
     """Get specific build details"""
-    build = await builds_collection.find_one({"_id": ObjectId(build_id)})
+    build = await builds_collection.find_one(
+        {"_id": ObjectId(build_id)},
+        {"logs": {"$slice": -200}}  # Only the most recent log lines
+    )
     
     if not build:
         raise HTTPException(status_code=404, detail="Build not found")
     
-    build["_id"] = str(build["_id"])
-    if "started_at" in build:
-        build["started_at"] = build["started_at"].isoformat()
-    if "updated_at" in build:
-        build["updated_at"] = build["updated_at"].isoformat()
-    
-    return build
+    return MongoJSONResponse(build)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,41 @@
+"""arq worker that runs AOSP builds outside the API process.
+
+Start it from the backend directory with:
+
+    arq worker.WorkerSettings
+"""
+from arq.connections import RedisSettings
+
+from server import (
+    ACTIVE_STATE_ID, BuildConfig, REDIS_URL, execute_build,
+    reconcile_active_build, redis_state, state_collection
+)
+
+async def build_task(ctx, config_dict: dict, build_id: str):
+    """Run a queued build through the regular build stages"""
+    # The slot may have been taken over while the job sat in the queue
+    state = await state_collection.find_one({"_id": ACTIVE_STATE_ID}) or {}
+    if state.get("build_id") != build_id:
+        return
+    
+    await execute_build(BuildConfig(**config_dict), build_id)
+
+async def startup(ctx):
+    # Log batches are relayed to the API processes over the worker's connection
+    redis_state["pool"] = ctx["redis"]
+    # A job interrupted by a previous worker is dropped by arq (max_tries = 1)
+    # without running execute_build's cleanup; free its slot
+    await reconcile_active_build()
+
+async def shutdown(ctx):
+    redis_state["pool"] = None
+
+class WorkerSettings:
+    functions = [build_task]
+    on_startup = startup
+    on_shutdown = shutdown
+    redis_settings = RedisSettings.from_dsn(REDIS_URL or "redis://localhost:6379")
+    # One build at a time; builds can take many hours and must not be retried
+    max_jobs = 1
+    max_tries = 1
+    job_timeout = 48 * 60 * 60